@@ -1,9 +1,14 @@
-import altair as alt
+import hashlib
+import inspect
+import os
+import tempfile
+from copy import deepcopy
+from functools import cache
+from pathlib import Path
+
 import polars as pl
 import streamlit as st
 
-alt.themes.enable("vox")
-
 st.set_page_config(
     page_title="Europe's Unicorn Startups",
     page_icon=":chart_with_upwards_trend:",
@@ -13,15 +18,22 @@ st.set_page_config(
 
 DATA_FILE = "unicorns-pitchbook.csv"
 
-
-# Functions
-@st.cache_data
-def prepare_dataset(data_file: str) -> pl.DataFrame:
-    # Read the csv file
-    df = pl.read_csv(data_file)
-
-    # Filter the dataframe to only include European countries
-    european_countries = [
+# Columns of the csv file used by the dashboard, the rest are never parsed
+CSV_COLUMNS = [
+    "company",
+    "country",
+    "vertical",
+    "status",
+    "unicorn_month",
+    "raised_usd",
+    "valuation_usd",
+]
+
+# European countries kept in the dashboard, as a Series so is_in does not
+# convert the list on every call
+EUROPEAN_COUNTRIES = pl.Series(
+    "country",
+    [
         "Austria",
         "Belgium",
         "Bulgaria",
@@ -50,253 +62,340 @@ def prepare_dataset(data_file: str) -> pl.DataFrame:
         "Spain",
         "Sweden",
         "United Kingdom",
-    ]
+    ],
+    dtype=pl.String,
+)
 
-    df = df.filter(pl.col("country").is_in(european_countries))
+# Low cardinality string columns are stored as enums, so filtering and
+# grouping compare integer codes instead of strings
+COUNTRIES_ENUM = pl.Enum(EUROPEAN_COUNTRIES.replace("United Kingdom", "UK"))
+
+# Company statuses kept in the dashboard
+STATUSES = ["Active", "Exited"]
+
+# Vega-Lite spec templates, the chart functions below only fill in the fields
+# instead of going through Altair
+VEGA_LITE_SCHEMA = "https://vega.github.io/schema/vega-lite/v5.json"
+VEGA_LITE_USERMETA = {"embedOptions": {"theme": "vox"}}
+
+BAR_SPEC_TEMPLATE = {
+    "width": 1000 / 4,
+    "encoding": {
+        "y": {
+            "field": None,
+            "type": "nominal",
+            "sort": {"field": "count", "op": "sum", "order": "descending"},
+            "title": None,
+            "axis": {
+                "labelColor": "black",
+                "labelBaseline": "middle",
+                "labels": True,
+                "labelPadding": 80,
+            },
+        },
+        "x": {"field": None, "type": "quantitative", "title": None, "axis": None},
+    },
+    "layer": [
+        {"mark": {"type": "bar"}},
+        {
+            "mark": {"type": "text", "align": "left", "baseline": "middle", "dx": 3},
+            "encoding": {"text": {"field": None, "type": "quantitative"}},
+        },
+    ],
+}
+
+BAR_CHARTS_SPEC_TEMPLATE = {
+    "$schema": VEGA_LITE_SCHEMA,
+    "usermeta": VEGA_LITE_USERMETA,
+    "config": {
+        "view": {"stroke": None},
+        "concat": {"spacing": 10},
+        "axisY": {"labelPadding": 70, "labelAlign": "left"},
+    },
+}
+
+YEARLY_SPEC_TEMPLATE = {
+    "$schema": VEGA_LITE_SCHEMA,
+    "usermeta": VEGA_LITE_USERMETA,
+    "width": 1000,
+    "height": 400,
+    "mark": {"type": "bar"},
+    "encoding": {
+        "x": {"field": "unicorn_year", "type": "ordinal", "title": None},
+        "y": {"field": "count", "type": "quantitative", "title": "Number of Unicorns"},
+        "color": {
+            "field": None,
+            "type": "nominal",
+            "sort": {"field": "count", "op": "sum", "order": "descending"},
+        },
+        "order": {"field": "count", "type": "quantitative", "sort": "descending"},
+        "tooltip": [
+            {"field": None, "type": "nominal"},
+            {"field": "count", "type": "quantitative"},
+        ],
+    },
+}
 
-    # Rename United Kingdom to UK
 
-    df = df.with_columns(pl.col("country").str.replace(r"United Kingdom", "UK"))
+# Functions
+def usd_to_billions(column: str) -> pl.Expr:
+    # Strip the leading "$" and the trailing "M"/"B" in a single slice and scale
+    # by the suffix, without going through the regex engine
+    amount = (
+        pl.col(column)
+        .str.slice(1, pl.col(column).str.len_bytes() - 2)
+        .cast(pl.Float64, strict=False)
+    )
+    return (
+        pl.when(pl.col(column).str.ends_with("B"))
+        .then(amount)
+        .when(pl.col(column).str.ends_with("M"))
+        .then(amount / 1e3)
+        .otherwise(0.0)
+        .alias(column)
+    )
 
-    # Filter out only Active and Exited companies
-    df = df.filter(pl.col("status").is_in(["Active", "Exited"]))
 
-    # Delete $ symbol from raised_usd and valuation_usd columns
-    # And convert M and B to numbers and N/A to 0
-    df = df.with_columns(
-        pl.col("raised_usd")
-        .str.replace("N/A", "0")
-        .str.replace("\\$", "")
-        .str.replace("M", "e6")
-        .str.replace("B", "e9")
-        .cast(pl.Float64)
-        .mul(1 / 1e9)
-        .alias("raised_usd")
+def clean_dataset(data_file: str) -> pl.DataFrame:
+    # Build the whole pipeline lazily so Polars can push the filters down to
+    # the csv reader and only materialize the columns used by the dashboard
+    df = (
+        pl.scan_csv(data_file)
+        .select(CSV_COLUMNS)
+        # Filter the dataframe to only include European countries
+        .filter(pl.col("country").is_in(EUROPEAN_COUNTRIES))
+        # Filter out only Active and Exited companies
+        .filter(pl.col("status").is_in(STATUSES))
+        .with_columns(
+            [
+                # Rename United Kingdom to UK
+                pl.col("country").str.replace(r"United Kingdom", "UK"),
+                # Convert "$1.2B" / "$350.0M" strings to billions and N/A to 0
+                usd_to_billions("raised_usd"),
+                usd_to_billions("valuation_usd"),
+                # Extract the year from the founded column, "unicorn_month" is
+                # always formatted as "<Month> YYYY"
+                pl.col("unicorn_month")
+                .str.slice(-4, 4)
+                .cast(pl.Int32)
+                .alias("unicorn_year"),
+            ]
+        )
+        .with_columns(pl.col("country").cast(COUNTRIES_ENUM))
+        # Only keep the columns shown in the charts and table, status is only
+        # needed for the filter above
+        .select(
+            [
+                "company",
+                "vertical",
+                "country",
+                "unicorn_year",
+                "valuation_usd",
+                "raised_usd",
+            ]
+        )
+        .collect()
     )
 
-    df = df.with_columns(
-        pl.col("valuation_usd")
-        .str.replace("N/A", "0")
-        .str.replace("\\$", "")
-        .str.replace("M", "e6")
-        .str.replace("B", "e9")
-        .cast(pl.Float64)
-        .mul(1 / 1e9)
-        .alias("valuation_usd")
-    )
+    # The verticals are only known once the data is read
+    verticals_enum = pl.Enum(df["vertical"].unique().sort())
+    return df.with_columns(pl.col("vertical").cast(verticals_enum))
 
-    # Extract the year from the founded column
-    df = df.with_columns(
-        pl.col("unicorn_month")
-        .str.extract(r"(\d{4})")
-        .cast(pl.Int32)
-        .alias("unicorn_year")
-    )
-    return df
 
+def dataset_path(data_file: str) -> Path:
+    # The parquet file name carries a hash of the cleaning code and its
+    # constants, so a file written by an older version of the app is never read
+    source = "".join(inspect.getsource(f) for f in (usd_to_billions, clean_dataset))
+    source += repr((CSV_COLUMNS, EUROPEAN_COUNTRIES.to_list(), STATUSES))
+    version = hashlib.sha256(source.encode()).hexdigest()[:12]
+    return Path(data_file).with_suffix(f".{version}.parquet")
 
-def bar_chart(
-    df: pl.DataFrame,
-    y: str,
-    x: str,
-    func: str,
-    title: str = "",
-    is_y_label: bool = True,
-) -> alt.Chart:
-    bars = (
-        alt.Chart(df, title=title)
-        .mark_bar()
-        .encode(
-            y=alt.Y(
-                f"{y}:N",
-                sort=alt.EncodingSortField(op="count", order="descending"),
-                title=None,
-                axis=alt.Axis(
-                    labelColor="black",
-                    labelBaseline="middle",
-                    labels=is_y_label,
-                    labelPadding=80,
-                ),
-            ),
-            x=alt.X(f"{func}({x})", title=None, axis=None),
+
+def save_dataset(df: pl.DataFrame, parquet_file: Path, data_file: str) -> None:
+    # Write to a temporary file and move it into place, so an interrupted write
+    # never leaves a truncated parquet file behind. If the directory is not
+    # writable the app simply keeps working from the in-memory frame
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            dir=parquet_file.parent, prefix=f"{parquet_file.name}.", suffix=".tmp"
         )
-    )
+        os.close(fd)
+        tmp_file = Path(tmp_name)
+        try:
+            df.write_parquet(tmp_file, compression="zstd")
+            tmp_file.replace(parquet_file)
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+        # Remove the files left by previous versions of the cleaning code
+        for stale_file in parquet_file.parent.glob(f"{Path(data_file).stem}*.parquet"):
+            if stale_file != parquet_file:
+                stale_file.unlink(missing_ok=True)
+    except OSError:
+        pass
 
-    text = bars.mark_text(
-        align="left",
-        baseline="middle",
-        dx=3,
-    ).encode(text=f"{func}({x}):Q")
 
-    return (bars + text).properties(width=1000 / 4)
+@st.cache_data
+def prepare_dataset(
+    data_file: str,
+) -> tuple[pl.DataFrame, list[str], list[str], tuple[int, int]]:
+    # The cleaned dataset is stored as parquet next to the csv file and only
+    # rebuilt when the csv or the cleaning code changes, so the csv is parsed
+    # once, not per session
+    parquet_file = dataset_path(data_file)
+    if (
+        parquet_file.exists()
+        and parquet_file.stat().st_mtime >= Path(data_file).stat().st_mtime
+    ):
+        df = pl.scan_parquet(parquet_file).collect()
+    else:
+        df = clean_dataset(data_file)
+        save_dataset(df, parquet_file, data_file)
 
+    # Options for the selectboxes, computed once instead of on every rerun
+    countries = df["country"].unique().sort().to_list()
+    verticals = df["vertical"].unique().sort().to_list()
+    # Bounds of the year slider
+    years = df.select(
+        pl.col("unicorn_year").min().alias("min"),
+        pl.col("unicorn_year").max().alias("max"),
+    ).row(0)
+    return df, countries, verticals, years
 
-def combine_bar_charts(*plots):
-    combined = alt.vconcat()
-    for plot in plots:
-        combined |= plot
-    return (
-        combined.configure_view(stroke=None)
-        .configure_concat(spacing=10)
-        .configure_axisY(labelPadding=70, labelAlign="left")
+
+@st.cache_data
+def filter_dataset(
+    data_file: str, location: str, industry: str, year_1b: tuple[int, int]
+) -> pl.DataFrame:
+    df, *_ = prepare_dataset(data_file)
+
+    # Build a single predicate so the frame is filtered in one pass
+    predicate = pl.col("unicorn_year").is_between(year_1b[0], year_1b[1])
+
+    if location != "All":
+        predicate &= pl.col("country") == location
+
+    if industry != "All":
+        predicate &= pl.col("vertical") == industry
+
+    return df.filter(predicate)
+
+
+def aggregate_by(df: pl.DataFrame, by: str) -> pl.DataFrame:
+    # Number of unicorns, total valuation and total funding per category, so
+    # the bar charts only have to ship one row per category to the browser
+    return df.group_by(by).agg(
+        pl.len().alias("count"),
+        pl.col("valuation_usd").sum(),
+        pl.col("raised_usd").sum(),
     )
 
 
-def main():
-    # Main dataset
-    df = prepare_dataset(DATA_FILE)
+def count_by_year(df: pl.DataFrame, by: str) -> pl.DataFrame:
+    # Number of unicorns per year and category for the stacked yearly charts
+    return df.group_by("unicorn_year", by).agg(pl.len().alias("count"))
 
-    # Page layout
-    st.markdown("## Europe's Unicorn Startups")
-    st.markdown(
-        "##### Source: [Pitchbook](https://pitchbook.com/news/articles/unicorn-startups-list-trends)"
+
+@st.cache_data
+def summarize_dataset(
+    data_file: str, location: str, industry: str, year_1b: tuple[int, int]
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    # Chart data for one widget selection, cached so revisiting a selection
+    # does not run the group_bys again
+    filtered_df = filter_dataset(data_file, location, industry, year_1b)
+    return (
+        aggregate_by(filtered_df, "country"),
+        aggregate_by(filtered_df, "vertical"),
+        count_by_year(filtered_df, "country"),
+        count_by_year(filtered_df, "vertical"),
     )
 
-    # Filters
-    col_1, col_2, col_3, _ = st.columns([1, 1, 1, 3])
 
-    # Total scorecards
-    col_1, col_2, col_3, _ = st.columns([2, 1.5, 1.5, 1.5])
-    with col_1:
-        st.metric(label="Total Unicorns", value=df.height)
+def bar_chart(
+    y: str,
+    x: str,
+    title: str = "",
+    is_y_label: bool = True,
+) -> dict:
+    spec = deepcopy(BAR_SPEC_TEMPLATE)
+    spec["title"] = title
+    spec["encoding"]["y"]["field"] = y
+    spec["encoding"]["y"]["axis"]["labels"] = is_y_label
+    spec["encoding"]["x"]["field"] = x
+    spec["layer"][1]["encoding"]["text"]["field"] = x
+    return spec
+
+
+def combine_bar_charts(*plots: dict) -> dict:
+    # The charts share the data passed to st.vega_lite_chart, so it is only
+    # sent once for the whole row
+    return {**BAR_CHARTS_SPEC_TEMPLATE, "hconcat": list(plots)}
+
+
+@cache
+def bar_charts(y: str) -> dict:
+    # The specs don't depend on the data, so each row is only built once
+    return combine_bar_charts(
+        bar_chart(y=y, x="count", title="Number of Unicorns"),
+        bar_chart(y=y, x="valuation_usd", title="Valuation ($B)", is_y_label=False),
+        bar_chart(y=y, x="raised_usd", title="Total Funding ($B)", is_y_label=False),
+    )
 
-    with col_2:
-        st.metric(label="Total Valuation ($B)", value=df["valuation_usd"].sum())
 
-    with col_3:
-        st.metric(label="Total Funding ($B)", value=df["raised_usd"].sum())
+@cache
+def yearly_bar_chart(color: str) -> dict:
+    spec = deepcopy(YEARLY_SPEC_TEMPLATE)
+    spec["encoding"]["color"]["field"] = color
+    spec["encoding"]["tooltip"][0]["field"] = color
+    return spec
+
 
+# Widget changes only rerun this fragment, not the page header and scorecards
+@st.fragment
+def dashboard(countries: list[str], verticals: list[str], years: tuple[int, int]):
+    col_1, col_2, col_3, _ = st.columns([2, 1.5, 1.5, 1.5])
     with col_1:
         location = st.selectbox(
             "Select country",
-            ["All"] + sorted(df["country"].unique()),
+            ["All"] + countries,
         )
 
     with col_2:
         industry = st.selectbox(
             "Select industry",
-            ["All"] + sorted(df["vertical"].unique()),
+            ["All"] + verticals,
         )
 
     # Add a filter for the year
     with col_3:
         year_1b = st.slider(
             "Select year",
-            min_value=df["unicorn_year"].min(),
-            max_value=df["unicorn_year"].max(),
-            value=(df["unicorn_year"].min(), df["unicorn_year"].max()),
+            min_value=years[0],
+            max_value=years[1],
+            value=years,
             step=1,
         )
 
     # Filter polars dataframe
-    if location == "All":
-        filtered_df = df
-    else:
-        filtered_df = df.filter(pl.col("country") == location)
-
-    if industry != "All":
-        filtered_df = filtered_df.filter(pl.col("vertical") == industry)
-
-    filtered_df = filtered_df.filter(
-        (pl.col("unicorn_year") >= year_1b[0]) & (pl.col("unicorn_year") <= year_1b[1])
-    )
+    filtered_df = filter_dataset(DATA_FILE, location, industry, year_1b)
 
     # Display the charts
-
-    st.altair_chart(
-        combine_bar_charts(
-            bar_chart(
-                df=filtered_df,
-                y="country",
-                x="company",
-                func="count",
-                title="Number of Unicorns",
-            ),
-            bar_chart(
-                df=filtered_df,
-                y="country",
-                x="valuation_usd",
-                func="sum",
-                title="Valuation ($B)",
-                is_y_label=False,
-            ),
-            bar_chart(
-                df=filtered_df,
-                y="country",
-                x="raised_usd",
-                func="sum",
-                title="Total Funding ($B)",
-                is_y_label=False,
-            ),
-        ),
+    agg_country, agg_vertical, yearly_country, yearly_vertical = summarize_dataset(
+        DATA_FILE, location, industry, year_1b
     )
 
+    st.vega_lite_chart(agg_country, bar_charts("country"))
+
     st.markdown("##### ")
 
-    st.altair_chart(
-        combine_bar_charts(
-            bar_chart(
-                df=filtered_df,
-                y="vertical",
-                x="company",
-                func="count",
-                title="Number of Unicorns",
-            ),
-            bar_chart(
-                df=filtered_df,
-                y="vertical",
-                x="valuation_usd",
-                func="sum",
-                title="Valuation ($B)",
-                is_y_label=False,
-            ),
-            bar_chart(
-                df=filtered_df,
-                y="vertical",
-                x="raised_usd",
-                func="sum",
-                title="Total Funding ($B)",
-                is_y_label=False,
-            ),
-        ),
-    )
+    st.vega_lite_chart(agg_vertical, bar_charts("vertical"))
 
-    st.altair_chart(
-        alt.Chart(filtered_df)
-        .mark_bar()
-        .encode(
-            x=alt.X("unicorn_year:O", title=None),
-            y=alt.Y("count()", title="Number of Unicorns"),
-            color=alt.Color(
-                "country:N", sort=alt.EncodingSortField(op="count", order="descending")
-            ),
-            order=alt.Order(
-                "count()",
-                sort="descending",
-            ),
-            tooltip=["country", "count()"],
-        )
-        .properties(width=1000, height=400)
-    )
+    st.vega_lite_chart(yearly_country, yearly_bar_chart(color="country"))
 
-    st.altair_chart(
-        alt.Chart(filtered_df)
-        .mark_bar()
-        .encode(
-            x=alt.X("unicorn_year:O", title=None),
-            y=alt.Y("count()", title="Number of Unicorns"),
-            color=alt.Color(
-                "vertical:N", sort=alt.EncodingSortField(op="count", order="descending")
-            ),
-            order=alt.Order(
-                "count()",
-                sort="descending",
-            ),
-            tooltip=["vertical", "count()"],
-        )
-        .properties(width=1000, height=400)
-    )
+    st.vega_lite_chart(yearly_vertical, yearly_bar_chart(color="vertical"))
 
+    # Streamlit serializes pyarrow tables directly, polars frames would be
+    # converted to pandas first
     st.dataframe(
         filtered_df.select(
             [
@@ -307,7 +406,7 @@ def main():
                 "valuation_usd",
                 "raised_usd",
             ]
-        ),
+        ).to_arrow(),
         column_config={
             "company": st.column_config.TextColumn(
                 "Company",
@@ -349,5 +448,33 @@ def main():
     )
 
 
+def main():
+    # Main dataset
+    df, countries, verticals, years = prepare_dataset(DATA_FILE)
+
+    # Page layout
+    st.markdown("## Europe's Unicorn Startups")
+    st.markdown(
+        "##### Source: [Pitchbook](https://pitchbook.com/news/articles/unicorn-startups-list-trends)"
+    )
+
+    # Total scorecards
+    col_1, col_2, col_3, _ = st.columns([2, 1.5, 1.5, 1.5])
+    total_unicorns, total_valuation, total_funding = df.select(
+        pl.len(), pl.col("valuation_usd").sum(), pl.col("raised_usd").sum()
+    ).row(0)
+    with col_1:
+        st.metric(label="Total Unicorns", value=total_unicorns)
+
+    with col_2:
+        st.metric(label="Total Valuation ($B)", value=round(total_valuation, 1))
+
+    with col_3:
+        st.metric(label="Total Funding ($B)", value=round(total_funding, 2))
+
+    # Filters, charts and table
+    dashboard(countries, verticals, years)
+
+
 if __name__ == "__main__":
     main()